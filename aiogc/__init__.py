@@ -1,5 +1,7 @@
-GOOGLEAPIS_BASE_URL = 'https://www.googleapis.com'
-GOOGLE_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+from typing import Final
+
+GOOGLEAPIS_BASE_URL: Final[str] = 'https://www.googleapis.com'
+GOOGLE_TOKEN_URI: Final[str] = 'https://oauth2.googleapis.com/token'
 
 __name__ = "aiogc"
 
@@ -1,33 +1,203 @@
-import functools
+import asyncio
+import datetime
+import uuid
+import weakref
+
 import aiohttp
+import yarl
 
-from typing import Generator, Literal, Optional
+from typing import Awaitable, Callable, ClassVar, Dict, Final, Iterable, List, Literal, Optional, Tuple, Union
 
 from . import GOOGLEAPIS_BASE_URL
+from .helpers import _json_dumps, _json_loads
 from .models import Credentials, Event
+from .transport import HttpxTransport
 
+_GOOGLEAPIS_URL: Final[yarl.URL] = yarl.URL(GOOGLEAPIS_BASE_URL, encoded=True)
 
-def fresh_credentials(func):
-    "a decorator to make sure credentials stay fresh, `self` argument is required"
-    @functools.wraps(func)
-    async def wrapper(self: "EventsManager", *args, **kwargs):
-        if not self.creds.is_fresh():
-            await self.creds.refresh(self.session)
-        return await func(self, *args, **kwargs)
+# how long before expiry the access token gets refreshed in the background
+TOKEN_REFRESH_ADVANCE: Final[datetime.timedelta] = datetime.timedelta(seconds=60)
+# how long to wait before retrying a failed background refresh, doubled after every failure in a row
+TOKEN_REFRESH_RETRY: Final[datetime.timedelta] = datetime.timedelta(seconds=10)
+TOKEN_REFRESH_RETRY_MAX: Final[datetime.timedelta] = datetime.timedelta(minutes=10)
+# the most sub-requests google accepts in a single batch request
+BATCH_LIMIT: Final[int] = 50
+# connections kept per host, also the default concurrency of the *_many methods
+CONNECTIONS_PER_HOST: Final[int] = 16
+
+
+def _make_session() -> aiohttp.ClientSession:
+    "a session with a connector tuned for talking to googleapis.com only"
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=32,
+            limit_per_host=CONNECTIONS_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            force_close=False,
+        ),
+        json_serialize=_json_dumps,
+    )
+
+
+def _build_batch_body(requests: List[Tuple[str, str, Optional[str]]], boundary: str) -> str:
+    "a multipart/mixed batch body of (method, path, json body) requests, Content-ID being their index"
+    parts = []
+    for content_id, (method, path, body) in enumerate(requests):
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <{content_id}>\r\n\r\n"
+            f"{method} {path} HTTP/1.1\r\n"
+            # the CRLF in front of the next boundary belongs to the delimiter, not to this part
+            + (f"Content-Type: application/json\r\n\r\n{body}\r\n" if body is not None else "\r\n\r\n")
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts)
+
+
+def _parse_batch_response(body: str, boundary: str) -> Dict[int, Tuple[int, str, str]]:
+    """
+    maps Content-ID of every part of a multipart/mixed batch response to its status, reason and body,
+    parts that can't be read are left out
+    """
+    responses = {}
+    for part in body.split(f"--{boundary}")[1:]:
+        if part.startswith("--"):
+            break
+        outer_headers, _, inner = part.partition("\r\n\r\n")
+        head, _, payload = inner.partition("\r\n\r\n")
+        content_id = next(
+            (
+                line.split(":", 1)[1].strip()
+                for line in outer_headers.split("\r\n")
+                if line.lower().startswith("content-id:")
+            ),
+            "",
+        )
+        index = content_id.strip("<>").rsplit("-", 1)[-1]
+        status_line = head.split("\r\n", 1)[0].split(" ", 2)
+        if not index.isdigit() or len(status_line) < 2 or not status_line[1].isdigit():
+            # an unreadable part, its operation ends up without a response
+            continue
+        reason = status_line[2] if len(status_line) > 2 else ""
+        responses[int(index)] = (int(status_line[1]), reason, payload.strip())
+    return responses
+
+
+def _close_connector(connector: Optional[aiohttp.BaseConnector]):
+    "closes the sockets of a session whose manager was dropped without being stopped"
+    if connector is None:
+        return
+    if hasattr(connector, "_close"):
+        # since aiohttp 3.7 close() has to be awaited, which a finalizer can't do,
+        # while _close() underneath it drops the sockets synchronously
+        connector._close()
+    else:
+        connector.close()
+
+
+async def _refresh_soon(
+    manager_ref: "weakref.ref[EventsManager]", token: Optional[str], delay: float, retry: datetime.timedelta
+):
+    "refreshes the credentials after `delay` seconds unless the manager is gone by then"
+    await asyncio.sleep(delay)
+    manager = manager_ref()
+    if manager is None:
+        return
+    if manager.creds.access_token is not token:
+        # the token has been refreshed elsewhere while this task was sleeping
+        manager._schedule_refresh()
+        return
+    try:
+        await manager._refresh_credentials()
+    except Exception as e:
+        if isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500:
+            # e.g. a revoked refresh token, retrying won't help; the next request raises it inline
+            return
+        # a transient failure, the inline check in the request methods surfaces it meanwhile
+        manager._schedule_refresh(retry.total_seconds(), min(retry * 2, TOKEN_REFRESH_RETRY_MAX))
+
+
+def _list_params(
+    params: dict,
+    timeZone: str,
+    maxResults: Optional[int],
+    orderBy: Optional[str],
+    q: Optional[str],
+    singleEvents: Optional[str],
+    syncToken: Optional[str],
+    timeMax: Optional[str],
+    timeMin: Optional[str],
+    updatedMin: Optional[str],
+) -> List[Tuple[str, Union[str, int]]]:
+    "query pairs for EventsManager.list, `params` being the extra ones passed by the caller"
+    query: List[Tuple[str, Union[str, int]]] = [("timeZone", timeZone)]
+    if maxResults is not None:
+        query.append(("maxResults", maxResults))
+    if orderBy is not None:
+        query.append(("orderBy", orderBy))
+    if q is not None:
+        query.append(("q", q))
+    if singleEvents is not None:
+        query.append(("singleEvents", singleEvents))
+    if syncToken is not None:
+        query.append(("syncToken", syncToken))
+    if timeMax is not None:
+        query.append(("timeMax", timeMax))
+    if timeMin is not None:
+        query.append(("timeMin", timeMin))
+    if updatedMin is not None:
+        query.append(("updatedMin", updatedMin))
+    if params:
+        params.pop("timeZone", None)
+        query.extend(params.items())
+    return query
 
-    return wrapper
+
+async def _gather_bounded(func: Callable[..., Awaitable], items: Iterable, concurrency: int, *args) -> List:
+    "awaits `func(item, *args)` for every item with at most `concurrency` of them running at once"
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with semaphore:
+            return await func(item, *args)
+
+    return await asyncio.gather(*(one(item) for item in items))
 
 
 class EventsManager:
     "a wrapper class for making stuff possible in a simpler way"
 
+    __slots__ = (
+        "creds",
+        "tz",
+        "calendar_id",
+        "session",
+        "version",
+        "_share_session",
+        "_header",
+        "_header_token",
+        "_events_url",
+        "api_url",
+        "_batch_url",
+        "_refresh_task",
+        "_refreshing",
+        "_finalizer",
+        "__weakref__",
+    )
+
+    _shared_session: ClassVar[Optional[aiohttp.ClientSession]] = None
+
     def __init__(
         self,
         credentials: Credentials,
         timezone: str,
         calendar_id: str = "primary",
-        session: Optional[aiohttp.ClientSession] = None,
+        session: Union[aiohttp.ClientSession, HttpxTransport, None] = None,
         version: str = "v3",
+        share_session: bool = False,
     ):
         """
         a shared state holder for unchanging variables in events managing
@@ -36,34 +206,109 @@ class EventsManager:
             credentials (Credentials): aiogc.Credentials instance
             timezone (str): `Europe/London` for example
             calendar_id (str, optional): id of the calendar to work with. Defaults to "primary".
-            session (aiohttp.ClientSession, optional): Session instance if you need something special. Defaults to None.
+            session (aiohttp.ClientSession, optional): Session instance if you need something special,
+                pass aiogc.transport.HttpxTransport() for HTTP/2. Defaults to None.
             version (str, optional): api version. not recommended to change. Defaults to "v3".
+            share_session (bool, optional): use one session for all the managers, handy when working
+                with many calendars at once. Ignored if `session` is passed. Defaults to False.
         """
         self.creds = credentials
         self.tz = timezone
         self.calendar_id = calendar_id
         self.session = session
         self.version = version
+        self._share_session = share_session and session is None
+        self._header_token = credentials.access_token
+        self._header = {"Authorization": f"Bearer {credentials.access_token}"}
+        self._events_url = (
+            _GOOGLEAPIS_URL / "calendar" / version / "calendars" / calendar_id / "events"
+        )
+        self.api_url = str(self._events_url)
+        self._batch_url = _GOOGLEAPIS_URL / "batch" / "calendar" / version
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Future] = None
+        self._finalizer: Optional[weakref.finalize] = None
+
+    @classmethod
+    def shared_session(cls) -> aiohttp.ClientSession:
+        "the session shared by managers created with `share_session=True`"
+        if EventsManager._shared_session is None or EventsManager._shared_session.closed:
+            EventsManager._shared_session = _make_session()
+        return EventsManager._shared_session
+
+    @classmethod
+    async def close_shared(cls):
+        "closes the shared session, call it once all the sharing managers are done"
+        if EventsManager._shared_session is not None:
+            await EventsManager._shared_session.close()
+            EventsManager._shared_session = None
 
-    @property
-    def header(self) -> dict[str, str]:
-        "a dict to pass as a header"
-        return {"Authorization": f"Bearer {self.creds.access_token}"}
+    async def _get_session(self) -> Union[aiohttp.ClientSession, HttpxTransport]:
+        "returns the session, creating one tuned for googleapis.com if there is none yet"
+        if self.session is None or self.session.closed:
+            if self._share_session:
+                self.session = EventsManager.shared_session()
+            else:
+                self.session = _make_session()
+                if self._finalizer is not None:
+                    self._finalizer.detach()
+                self._finalizer = weakref.finalize(self, _close_connector, self.session.connector)
+        return self.session
 
-    @property
-    def api_url(self):
-        "general url used for the requests"
-        return f"{GOOGLEAPIS_BASE_URL}/calendar/{self.version}/calendars/{self.calendar_id}/events"
+    def _auth_header(self) -> Dict[str, str]:
+        "the cached header, rebuilt whenever the credentials hold another token"
+        if self.creds.access_token is not self._header_token:
+            self._header_token = self.creds.access_token
+            self._header = {"Authorization": f"Bearer {self._header_token}"}
+        return self._header
+
+    async def _refresh_credentials(self):
+        "refreshes the access token, concurrent callers share a single token request"
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._fetch_token())
+        await asyncio.shield(self._refreshing)
+
+    async def _fetch_token(self):
+        try:
+            await self.creds.refresh(await self._get_session())
+        finally:
+            self._refreshing = None
+        self._schedule_refresh()
+
+    def _schedule_refresh(
+        self, delay: Optional[float] = None, retry: Optional[datetime.timedelta] = None
+    ):
+        """
+        plans a background refresh shortly before the access token expires or after `delay` seconds,
+        `retry` being the wait before another attempt if this one fails
+        """
+        if self._refresh_task is not None and self._refresh_task is not asyncio.current_task():
+            self._refresh_task.cancel()
+        if delay is None:
+            until = self.creds.expires_at - datetime.datetime.now() - TOKEN_REFRESH_ADVANCE
+            delay = max(0.0, until.total_seconds())
+        self._refresh_task = asyncio.create_task(
+            _refresh_soon(weakref.ref(self), self.creds.access_token, delay, retry or TOKEN_REFRESH_RETRY)
+        )
 
     async def start(self):
         "for using instead of async with block"
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        await self._get_session()
+        self._schedule_refresh()
         return self
 
     async def stop(self):
         "for using instead of async with block"
-        await self.session.close()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._refreshing is not None:
+            self._refreshing.cancel()
+        if self.session is not None and not self._share_session:
+            await self.session.close()
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
 
     async def __aenter__(self):
         return await self.start()
@@ -71,7 +316,6 @@ class EventsManager:
     async def __aexit__(self, *args, **kwargs):
         await self.stop()
 
-    @fresh_credentials
     async def list(
         self,
         *,
@@ -84,86 +328,201 @@ class EventsManager:
         timeMin: Optional[str] = None,
         updatedMin: Optional[str] = None,
         **params,
-    ) -> Generator[Event, None, None]:
+    ) -> list[Event]:
         """
         refer to https://developers.google.com/calendar/api/v3/reference/events/list
         """
-        extra_params = {
-            "maxResults": maxResults,
-            "orderBy": orderBy,
-            "q": q,
-            "singleEvents": singleEvents,
-            "syncToken": syncToken,
-            "timeMax": timeMax,
-            "timeMin": timeMin,
-            "updatedMin": updatedMin,
-            "timeZone": self.tz,
-        }
-        for key, value in extra_params.items():
-            if value:
-                params[key] = value
-        async with self.session.get(
-            url=self.api_url,
-            params=params,
-            headers=self.header,
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        async with (await self._get_session()).get(
+            url=self._events_url,
+            params=_list_params(
+                params, self.tz, maxResults, orderBy, q, singleEvents, syncToken, timeMax, timeMin, updatedMin
+            ),
+            headers=self._auth_header(),
             raise_for_status=True,
         ) as r:
-            return (Event(**item) for item in (await r.json())["items"])
+            return [Event(**item) for item in _json_loads(await r.read())["items"]]
 
-    @fresh_credentials
     async def insert(
-        self, event: Event, sendUpdates: Literal["all", "externalOnly", "none"] = None
+        self, event: Event, sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None
     ) -> Event:
         """
         refer to https://developers.google.com/calendar/api/v3/reference/events/insert
         """
-        async with self.session.post(
-            url=self.api_url,
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        async with (await self._get_session()).post(
+            url=self._events_url,
             json=event.dict(),
-            headers=self.header,
-            params={"sendUpdates": sendUpdates} if sendUpdates else {},
+            headers=self._auth_header(),
+            params=(("sendUpdates", sendUpdates),) if sendUpdates else None,
             raise_for_status=True,
         ) as r:
-            return Event(**(await r.json()))
+            return Event(**_json_loads(await r.read()))
 
-    @fresh_credentials
     async def update(
-        self, event: Event, sendUpdates: Literal["all", "externalOnly", "none"] = None
+        self, event: Event, sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None
     ) -> Event:
         """
         refer to https://developers.google.com/calendar/api/v3/reference/events/update
         """
-        async with self.session.put(
-            url=f"{self.api_url}/{event.id}",
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        async with (await self._get_session()).put(
+            url=self._events_url / event.id,
             json=event.dict(),
-            headers=self.header,
-            params={"sendUpdates": sendUpdates} if sendUpdates else {},
+            headers=self._auth_header(),
+            params=(("sendUpdates", sendUpdates),) if sendUpdates else None,
             raise_for_status=True,
         ) as r:
-            return Event(**(await r.json()))
+            return Event(**_json_loads(await r.read()))
 
-    @fresh_credentials
     async def delete(
-        self, evend_id: str, sendUpdates: Literal["all", "externalOnly", "none"] = None
+        self, evend_id: str, sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None
     ) -> None:
         """
         refer to https://developers.google.com/calendar/api/v3/reference/events/delete
         """
-        await self.session.delete(
-            url=f"{self.api_url}/{evend_id}",
-            headers=self.header,
-            params={"sendUpdates": sendUpdates} if sendUpdates else {},
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        async with (await self._get_session()).delete(
+            url=self._events_url / evend_id,
+            headers=self._auth_header(),
+            params=(("sendUpdates", sendUpdates),) if sendUpdates else None,
             raise_for_status=True,
-        )
+        ) as r:
+            await r.release()
 
-    @fresh_credentials
     async def get(self, evend_id: str, timezone: Optional[str] = None) -> None:
         """
         refer to https://developers.google.com/calendar/api/v3/reference/events/get
         """
-        await self.session.get(
-            url=f"{self.api_url}/{evend_id}",
-            headers=self.header,
-            params={"timeZone": timezone or self.tz},
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        async with (await self._get_session()).get(
+            url=self._events_url / evend_id,
+            headers=self._auth_header(),
+            params=(("timeZone", timezone or self.tz),),
             raise_for_status=True,
+        ) as r:
+            await r.release()
+
+    async def batch(
+        self,
+        ops: List[Tuple[Literal["insert", "update", "delete"], Union[Event, str]]],
+        sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None,
+    ) -> List[Union[Event, None, Exception]]:
+        """
+        runs many inserts, updates and deletes in as few http requests as possible,
+        refer to https://developers.google.com/calendar/api/guides/batch
+
+        Operations are applied independently, so a failing one doesn't stop the others and
+        nothing is raised for it. Its place in the result holds the error instead: an
+        aiohttp.ClientResponseError with the status google gave to that very operation,
+        aiohttp.ClientPayloadError if its part of the reply is missing or unreadable, the error
+        of parsing the returned event, or the error of the whole http request it was sent in.
+        Check the results before retrying, otherwise the inserts that went through get duplicated.
+
+        Args:
+            ops (list): pairs like ("insert", event), ("update", event) or ("delete", event_id)
+            sendUpdates (str, optional): applied to every operation. Defaults to None.
+
+        Returns:
+            list: in the order of `ops`, resulting events, None for deletes or errors of the failed ones
+
+        Raises:
+            ValueError: if any of `ops` is malformed, checked before anything is sent
+        """
+        query = (("sendUpdates", sendUpdates),) if sendUpdates else None
+        requests = [self._batch_request(index, op, item, query) for index, (op, item) in enumerate(ops)]
+        results: List[Union[Event, None, Exception]] = []
+        for i in range(0, len(ops), BATCH_LIMIT):
+            chunk = ops[i:i + BATCH_LIMIT]
+            try:
+                results.extend(await self._batch(chunk, requests[i:i + BATCH_LIMIT]))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                results.extend(e for _ in chunk)
+        return results
+
+    def _batch_request(
+        self, index: int, op: str, item: Union[Event, str], query: Optional[Tuple[Tuple[str, str], ...]]
+    ) -> Tuple[str, str, Optional[str]]:
+        "method, path and body of the sub-request for the `index`-th of the batch operations"
+        if op == "insert" and isinstance(item, Event):
+            return "POST", self._events_url.with_query(query).raw_path_qs, _json_dumps(item.dict())
+        if op == "update" and isinstance(item, Event) and isinstance(item.id, str):
+            return "PUT", (self._events_url / item.id).with_query(query).raw_path_qs, _json_dumps(item.dict())
+        if op == "delete" and isinstance(item, str):
+            return "DELETE", (self._events_url / item).with_query(query).raw_path_qs, None
+        raise ValueError(
+            f"batch operation {index} must be ('insert', Event), ('update', Event with an id) "
+            f"or ('delete', event id), got {op!r} with {type(item).__name__}"
         )
+
+    async def _batch(
+        self, ops, requests: List[Tuple[str, str, Optional[str]]]
+    ) -> List[Union[Event, None, Exception]]:
+        if not self.creds.is_fresh():
+            await self._refresh_credentials()
+        boundary = uuid.uuid4().hex
+        body = _build_batch_body(requests, boundary)
+        async with (await self._get_session()).post(
+            url=self._batch_url,
+            data=body.encode(),
+            headers={**self._auth_header(), "Content-Type": f"multipart/mixed; boundary={boundary}"},
+            raise_for_status=True,
+        ) as r:
+            content_type = r.headers.get("Content-Type", "")
+            if "boundary=" not in content_type:
+                raise aiohttp.ClientPayloadError(f"batch response is not multipart: {content_type!r}")
+            response_boundary = content_type.split("boundary=", 1)[1].split(";", 1)[0].strip('"')
+            responses = _parse_batch_response((await r.read()).decode(), response_boundary)
+            results: List[Union[Event, None, Exception]] = []
+            for content_id, (op, _) in enumerate(ops):
+                if content_id not in responses:
+                    results.append(aiohttp.ClientPayloadError(f"no response to batch operation {content_id}"))
+                    continue
+                status, reason, payload = responses[content_id]
+                if status >= 400:
+                    results.append(
+                        aiohttp.ClientResponseError(r.request_info, r.history, status=status, message=reason)
+                    )
+                elif op == "delete":
+                    results.append(None)
+                else:
+                    try:
+                        results.append(Event(**_json_loads(payload)))
+                    except (ValueError, TypeError) as e:
+                        results.append(e)
+            return results
+
+    async def insert_many(
+        self,
+        events: Iterable[Event],
+        sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None,
+        *,
+        concurrency: int = CONNECTIONS_PER_HOST,
+    ) -> List[Event]:
+        "inserts the events concurrently, at most `concurrency` requests at a time"
+        return await _gather_bounded(self.insert, events, concurrency, sendUpdates)
+
+    async def update_many(
+        self,
+        events: Iterable[Event],
+        sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None,
+        *,
+        concurrency: int = CONNECTIONS_PER_HOST,
+    ) -> List[Event]:
+        "updates the events concurrently, at most `concurrency` requests at a time"
+        return await _gather_bounded(self.update, events, concurrency, sendUpdates)
+
+    async def delete_many(
+        self,
+        event_ids: Iterable[str],
+        sendUpdates: Optional[Literal["all", "externalOnly", "none"]] = None,
+        *,
+        concurrency: int = CONNECTIONS_PER_HOST,
+    ) -> None:
+        "deletes the events concurrently, at most `concurrency` requests at a time"
+        await _gather_bounded(self.delete, event_ids, concurrency, sendUpdates)
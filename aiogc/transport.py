@@ -0,0 +1,118 @@
+"""
+HTTP/2 transport for EventsManager.
+
+Anything passed as `session` to EventsManager only has to look like the small part
+of aiohttp.ClientSession this package uses: get/post/put/delete returning an async
+context manager with the response, `closed` and `close()`. The default transport is
+aiohttp.ClientSession itself; HttpxTransport adapts httpx.AsyncClient to the same shape
+so many concurrent requests can share one multiplexed HTTP/2 connection.
+"""
+import typing
+
+import aiohttp
+import multidict
+import yarl
+
+from .helpers import _json_dumps
+
+
+class _HttpxResponse:
+    "the part of aiohttp.ClientResponse used by this package"
+
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.history = ()
+        self.request_info = aiohttp.RequestInfo(
+            yarl.URL(str(response.url)),
+            response.request.method,
+            multidict.CIMultiDictProxy(multidict.CIMultiDict(response.request.headers.multi_items())),
+        )
+
+    def raise_for_status(self):
+        "raises the same error aiohttp would, so callers don't depend on the transport"
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                self.request_info,
+                self.history,
+                status=self.status,
+                message=self._response.reason_phrase,
+                headers=self.headers,
+            )
+
+    async def read(self) -> bytes:
+        return self._response.content
+
+    async def text(self, *args, **kwargs) -> str:
+        return self._response.text
+
+    async def json(self, *args, loads: typing.Optional[typing.Callable] = None, **kwargs) -> typing.Any:
+        return loads(self._response.content) if loads is not None else self._response.json()
+
+    async def release(self):
+        pass
+
+
+class _HttpxRequest:
+    def __init__(self, client, method: str, url, **kwargs):
+        self._client = client
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+
+    async def __aenter__(self) -> _HttpxResponse:
+        headers = dict(self._kwargs.get("headers") or {})
+        content = self._kwargs.get("data")
+        if "json" in self._kwargs:
+            content = _json_dumps(self._kwargs["json"])
+            headers["Content-Type"] = "application/json"
+        response = _HttpxResponse(
+            await self._client.request(
+                self._method,
+                str(self._url),
+                params=self._kwargs.get("params"),
+                headers=headers,
+                content=content,
+            )
+        )
+        if self._kwargs.get("raise_for_status"):
+            response.raise_for_status()
+        return response
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class HttpxTransport:
+    "an httpx.AsyncClient speaking HTTP/2, usable as the `session` of EventsManager"
+
+    def __init__(self, client=None, **kwargs):
+        """
+        Args:
+            client (httpx.AsyncClient, optional): a client to use. Defaults to a new one with http2 on.
+            **kwargs: passed to httpx.AsyncClient when `client` is not given
+        """
+        if client is None:
+            import httpx
+            client = httpx.AsyncClient(http2=True, **kwargs)
+        self.client = client
+
+    @property
+    def closed(self) -> bool:
+        return self.client.is_closed
+
+    async def close(self):
+        await self.client.aclose()
+
+    def get(self, url, **kwargs) -> _HttpxRequest:
+        return _HttpxRequest(self.client, "GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> _HttpxRequest:
+        return _HttpxRequest(self.client, "POST", url, **kwargs)
+
+    def put(self, url, **kwargs) -> _HttpxRequest:
+        return _HttpxRequest(self.client, "PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs) -> _HttpxRequest:
+        return _HttpxRequest(self.client, "DELETE", url, **kwargs)
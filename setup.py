@@ -16,6 +16,10 @@ setuptools.setup(
     install_requires=[
         'aiohttp>=3.5.1',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'http2': ['httpx[http2]'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,97 @@
+import email
+import email.policy
+
+from aiogc.client import _build_batch_body, _parse_batch_response
+
+BOUNDARY = "batch_boundary"
+REQUESTS = [
+    ("POST", "/calendar/v3/calendars/primary/events", '{"summary": "new"}'),
+    ("PUT", "/calendar/v3/calendars/primary/events/abc", '{"summary": "changed"}'),
+    ("DELETE", "/calendar/v3/calendars/primary/events/def?sendUpdates=all", None),
+]
+
+
+def _split_parts(body: str, boundary: str) -> dict:
+    "what a server sees: Content-ID of every part mapped to the http request inside it"
+    message = email.message_from_bytes(
+        f"Content-Type: multipart/mixed; boundary={boundary}\r\n\r\n".encode() + body.encode(),
+        policy=email.policy.HTTP,
+    )
+    return {part["Content-ID"]: part.get_payload() for part in message.iter_parts()}
+
+
+def _answer(parts: dict, boundary: str) -> str:
+    "a google like batch response to the parts, sent back in reverse order"
+    answers = []
+    for content_id, request in reversed(list(parts.items())):
+        head, _, body = request.partition("\r\n\r\n")
+        status = "204 No Content" if head.startswith("DELETE") else "200 OK"
+        answers.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id.strip('<>')}>\r\n\r\n"
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{body}\r\n"
+        )
+    return "".join(answers) + f"--{boundary}--\r\n"
+
+
+def test_build_batch_body_parts():
+    parts = _split_parts(_build_batch_body(REQUESTS, BOUNDARY), BOUNDARY)
+
+    assert list(parts) == ["<0>", "<1>", "<2>"]
+    for (method, path, body), request in zip(REQUESTS, parts.values()):
+        head, separator, payload = request.partition("\r\n\r\n")
+        assert head.split("\r\n")[0] == f"{method} {path} HTTP/1.1"
+        # every inner request, a bodiless DELETE too, ends its headers with a blank line
+        assert separator == "\r\n\r\n"
+        assert payload == (body or "")
+
+
+def test_batch_round_trip():
+    parts = _split_parts(_build_batch_body(REQUESTS, BOUNDARY), BOUNDARY)
+    responses = _parse_batch_response(_answer(parts, "response_boundary"), "response_boundary")
+
+    assert responses == {
+        0: (200, "OK", '{"summary": "new"}'),
+        1: (200, "OK", '{"summary": "changed"}'),
+        2: (204, "No Content", ""),
+    }
+
+
+def test_parse_batch_response_errors():
+    body = (
+        "--b\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-ID: <response-0>\r\n\r\n"
+        "HTTP/1.1 404 Not Found\r\n"
+        "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+        '{"error": {"code": 404, "message": "Not Found"}}\r\n'
+        "--b--\r\n"
+    )
+
+    status, reason, payload = _parse_batch_response(body, "b")[0]
+
+    assert (status, reason) == (404, "Not Found")
+    assert payload.startswith('{"error"')
+
+
+def test_parse_batch_response_leaves_out_unreadable_parts():
+    body = (
+        "--b\r\n"
+        "Content-Type: application/http\r\n\r\n"
+        "HTTP/1.1 200 OK\r\n\r\n"
+        '{"id": "without content id"}\r\n'
+        "--b\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-ID: <response-1>\r\n\r\n"
+        "garbage\r\n"
+        "--b\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-ID: <response-2>\r\n\r\n"
+        "HTTP/1.1 204\r\n\r\n\r\n"
+        "--b--\r\n"
+    )
+
+    assert _parse_batch_response(body, "b") == {2: (204, "", "")}
@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+
+import aiohttp
+import pytest
+import yarl
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import aiogc.client
+import aiogc.models
+from aiogc.client import EventsManager, _list_params
+from aiogc.models import Credentials, Event
+
+
+class GoogleStub:
+    "a local stand-in for the token and events endpoints"
+
+    def __init__(self):
+        self.token_status = 200
+        self.token_requests = 0
+        self.tokens_issued = 0
+        self.authorizations = []
+        self.batch_requests = 0
+        self.batch_replies = []
+        self.app = web.Application()
+        self.app.router.add_post("/token", self.token)
+        self.app.router.add_get("/calendar/v3/calendars/{calendar_id}/events", self.events)
+        self.app.router.add_post("/batch/calendar/v3", self.batch)
+
+    async def token(self, request):
+        self.token_requests += 1
+        if self.token_status != 200:
+            return web.json_response({"error": "invalid_grant"}, status=self.token_status)
+        self.tokens_issued += 1
+        return web.json_response({"access_token": f"token-{self.tokens_issued}", "expires_in": 3600})
+
+    async def events(self, request):
+        authorization = request.headers.get("Authorization")
+        self.authorizations.append(authorization)
+        if authorization != f"Bearer token-{self.tokens_issued}":
+            return web.Response(status=401)
+        return web.json_response({"items": []})
+
+    async def batch(self, request):
+        self.batch_requests += 1
+        if not self.batch_replies:
+            return web.Response(status=500)
+        return web.Response(
+            text=self.batch_replies.pop(0), headers={"Content-Type": "multipart/mixed; boundary=reply"}
+        )
+
+
+@pytest.fixture
+def google(monkeypatch):
+    "runs a scenario against GoogleStub served locally, with the package pointed at it"
+    stub = GoogleStub()
+
+    def run(scenario):
+        async def main():
+            server = TestServer(stub.app)
+            await server.start_server()
+            monkeypatch.setattr(aiogc.models, "GOOGLE_TOKEN_URI", str(server.make_url("/token")))
+            monkeypatch.setattr(aiogc.client, "_GOOGLEAPIS_URL", yarl.URL(str(server.make_url(""))))
+            try:
+                await scenario(stub)
+            finally:
+                await server.close()
+
+        asyncio.run(main())
+
+    return run
+
+
+def _credentials() -> Credentials:
+    return Credentials(client_id="id", client_secret="secret", scopes=[], refresh_token="refresh")
+
+
+def test_managers_sharing_credentials_send_the_refreshed_token(google):
+    async def scenario(stub):
+        credentials = _credentials()
+        first = EventsManager(credentials, "UTC", "first")
+        second = EventsManager(credentials, "UTC", "second")
+        try:
+            await first.list()
+            # credentials are fresh by now, so the second manager doesn't refresh on its own
+            await second.list()
+        finally:
+            await first.stop()
+            await second.stop()
+
+        assert stub.tokens_issued == 1
+        assert stub.authorizations == ["Bearer token-1", "Bearer token-1"]
+
+    google(scenario)
+
+
+def test_background_refresh_gives_up_on_a_rejected_refresh_token(google, monkeypatch):
+    monkeypatch.setattr(aiogc.client, "TOKEN_REFRESH_RETRY", datetime.timedelta(seconds=0.02))
+
+    async def scenario(stub):
+        stub.token_status = 400
+        manager = await EventsManager(_credentials(), "UTC").start()
+        try:
+            await asyncio.sleep(0.3)
+            assert stub.token_requests == 1
+            assert manager._refresh_task.done()
+        finally:
+            await manager.stop()
+
+    google(scenario)
+
+
+def test_background_refresh_backs_off_on_server_errors(google, monkeypatch):
+    monkeypatch.setattr(aiogc.client, "TOKEN_REFRESH_RETRY", datetime.timedelta(seconds=0.02))
+
+    async def scenario(stub):
+        stub.token_status = 503
+        manager = await EventsManager(_credentials(), "UTC").start()
+        try:
+            # attempts at about 0, 0.02, 0.06, 0.14 and 0.3 seconds, a fixed delay would make 15
+            await asyncio.sleep(0.3)
+            assert 3 <= stub.token_requests <= 6
+            assert not manager._refresh_task.done()
+        finally:
+            await manager.stop()
+
+    google(scenario)
+
+
+@pytest.mark.parametrize(
+    "bad_op",
+    [("bogus", "event-id"), ("update", Event(summary="no id yet")), ("delete", Event(id="event-id"))],
+)
+def test_batch_checks_every_op_before_sending_anything(google, bad_op):
+    async def scenario(stub):
+        manager = EventsManager(_credentials(), "UTC")
+        ops = [("insert", Event(summary=str(i))) for i in range(55)] + [bad_op]
+        try:
+            with pytest.raises(ValueError, match="batch operation 55"):
+                await manager.batch(ops)
+        finally:
+            await manager.stop()
+
+        assert stub.batch_requests == 0
+
+    google(scenario)
+
+
+def _batch_reply(parts) -> str:
+    "a multipart batch reply of (content id, http response) parts"
+    return "".join(
+        "--reply\r\n"
+        "Content-Type: application/http\r\n"
+        f"Content-ID: <response-{content_id}>\r\n\r\n"
+        f"{response}\r\n"
+        for content_id, response in parts
+    ) + "--reply--\r\n"
+
+
+def test_batch_keeps_results_when_parts_of_the_reply_are_missing_or_malformed(google):
+    async def scenario(stub):
+        ok = 'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{"id": "%s"}'
+        stub.batch_replies = [
+            _batch_reply([(i, ok % i) for i in range(50)]),
+            _batch_reply([(0, ok % 50), (2, "HTTP/1.1 200 OK\r\n\r\nnot json")]),
+        ]
+        manager = EventsManager(_credentials(), "UTC")
+        try:
+            results = await manager.batch([("insert", Event(summary=str(i))) for i in range(53)])
+        finally:
+            await manager.stop()
+
+        assert [event.id for event in results[:51]] == [str(i) for i in range(51)]
+        assert isinstance(results[51], aiohttp.ClientPayloadError)
+        assert isinstance(results[52], ValueError)
+
+    google(scenario)
+
+
+def _query(params=None, **arguments) -> dict:
+    "_list_params with every optional argument of EventsManager.list defaulting to None"
+    names = ("maxResults", "orderBy", "q", "singleEvents", "syncToken", "timeMax", "timeMin", "updatedMin")
+    return dict(_list_params(dict(params or {}), "UTC", *(arguments.get(name) for name in names)))
+
+
+def test_list_params_keeps_zero_max_results():
+    assert _query(maxResults=0) == {"timeZone": "UTC", "maxResults": 0}
+
+
+def test_list_params_skips_none_and_passes_extra_params():
+    assert _query({"showDeleted": "true"}, q="meeting") == {
+        "timeZone": "UTC",
+        "q": "meeting",
+        "showDeleted": "true",
+    }
+
+
+def test_list_params_time_zone_comes_from_the_manager():
+    query = _list_params({"timeZone": "Europe/London"}, "UTC", *[None] * 8)
+
+    assert [value for key, value in query if key == "timeZone"] == ["UTC"]